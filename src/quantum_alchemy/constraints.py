@@ -0,0 +1,83 @@
+import math
+from pymatgen.core import Molecule
+from pymatgen.core.bonds import CovalentBond
+
+def get_target_neighbors(xyz_file, target_indices, tol=0.2):
+    """
+    Returns, for each target position, the bonded target positions that come before it
+    in the enumeration order. Bonds are taken from the reference geometry.
+    """
+    mol = Molecule.from_file(xyz_file)
+    neighbors = [[] for _ in target_indices]
+    for i, gi in enumerate(target_indices):
+        for j in range(i):
+            if CovalentBond.is_bonded(mol[gi], mol[target_indices[j]], tol=tol):
+                neighbors[i].append(j)
+    num_bonds = sum(len(n) for n in neighbors)
+    print(f"Found {num_bonds} bonds between target atoms.")
+    return neighbors
+
+def constraints_from_args(args):
+    """Collects the enumeration constraints given on the command line (None if there are none)."""
+    constraints = {}
+    if args.charge_window:
+        constraints["charge_window"] = list(args.charge_window)
+    if args.count_limit:
+        constraints["color_counts"] = {color: [lo, hi] for color, lo, hi in args.count_limit}
+    if args.forbid_adjacent:
+        constraints["forbidden_neighbors"] = [list(pair) for pair in args.forbid_adjacent]
+        constraints["bond_tolerance"] = args.bond_tol
+    return constraints or None
+
+def _substitution_range(constraints, n_minus, n_plus, k_rem):
+    """
+    Range [a_lo, a_hi] of how many of the k_rem remaining substitutions can still be -1
+    such that the color counts and the net charge end inside their limits.
+    """
+    color_counts = constraints.get("color_counts", {})
+    minus_lo, minus_hi = color_counts.get(-1, (0, math.inf))
+    plus_lo, plus_hi = color_counts.get(1, (0, math.inf))
+
+    a_lo = max(0, minus_lo - n_minus, k_rem - (plus_hi - n_plus))
+    a_hi = min(k_rem, minus_hi - n_minus, k_rem - (plus_lo - n_plus))
+
+    if "charge_window" in constraints:
+        q_lo, q_hi = constraints["charge_window"]
+        # Final charge is (n_plus + k_rem - a) - (n_minus + a)
+        base = n_plus + k_rem - n_minus
+        a_lo = max(a_lo, math.ceil((base - q_hi) / 2))
+        a_hi = min(a_hi, math.floor((base - q_lo) / 2))
+    return a_lo, a_hi
+
+def is_feasible(constraints, n_minus, n_plus, k_rem):
+    """Checks whether the remaining substitutions can still satisfy the count and charge limits."""
+    a_lo, a_hi = _substitution_range(constraints, n_minus, n_plus, k_rem)
+    return a_lo <= a_hi
+
+def violates_neighbors(idx, current_struct, neighbors, forbidden):
+    """Checks the forbidden-neighbor rules between atom idx and its already assigned bonded atoms."""
+    color = current_struct[idx]
+    for j in neighbors[idx]:
+        if (color, current_struct[j]) in forbidden:
+            return True
+    return False
+
+def get_forbidden_pairs(constraints):
+    """Symmetric set of forbidden (color, color) pairs for bonded target atoms."""
+    forbidden = set()
+    for a, b in constraints.get("forbidden_neighbors", []):
+        forbidden.add((a, b))
+        forbidden.add((b, a))
+    return forbidden
+
+def get_constrained_counts_by_k(color_counts, constraints, max_k):
+    """
+    Sums the two-color PET counts over the (n_minus, n_plus) pairs allowed by the count and
+    charge limits. Forbidden-neighbor rules are not counted, so with those this is an upper bound.
+    """
+    counts = {k: 0 for k in range(max_k + 1)}
+    for (n_minus, n_plus), count in color_counts.items():
+        k = n_minus + n_plus
+        if k <= max_k and is_feasible(constraints, n_minus, n_plus, 0):
+            counts[k] += count
+    return counts
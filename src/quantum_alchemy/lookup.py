@@ -0,0 +1,172 @@
+import os
+import json
+import numpy as np
+import polars as pl
+from tqdm import tqdm
+
+# FNV-1a constants (64-bit), applied column by column so hashing stays vectorized
+FNV_OFFSET = np.uint64(0xcbf29ce484222325)
+FNV_PRIME = np.uint64(0x100000001b3)
+
+def _lex_less(a, b):
+    """Row-wise lexicographical a < b for two (m, n) arrays."""
+    diff = a != b
+    first = np.argmax(diff, axis=1)
+    rows = np.arange(len(a))
+    return diff[rows, first] & (a[rows, first] < b[rows, first])
+
+def canonicalize_patterns(patterns, p_invs, chunk_size=100_000):
+    """
+    Maps each substitution pattern to its orbit representative, the lexicographically
+    smallest image under the group (same canonical form as generate_prediction_set).
+    patterns is an (m, n) array of z-values; p_invs are the inverse permutations
+    from get_permutations_target_atoms.
+    """
+    patterns = np.asarray(patterns, dtype=np.int8)
+    canonical = patterns.copy()
+    p_invs = [np.asarray(p, dtype=np.intp) for p in p_invs]
+    for start in range(0, len(patterns), chunk_size):
+        chunk = patterns[start:start + chunk_size]
+        best = canonical[start:start + chunk_size]
+        for p_inv in p_invs:
+            image = chunk[:, p_inv]
+            less = _lex_less(image, best)
+            best[less] = image[less]
+    return canonical
+
+def pattern_keys(patterns):
+    """64-bit FNV-1a hash of each pattern row. Stable across runs and library versions."""
+    patterns = np.asarray(patterns, dtype=np.int64)
+    keys = np.full(len(patterns), FNV_OFFSET, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for j in range(patterns.shape[1]):
+            keys ^= patterns[:, j].view(np.uint64)
+            keys *= FNV_PRIME
+    return keys
+
+def get_index_path(feather_path):
+    return f"{os.path.splitext(feather_path)[0]}_index.feather"
+
+def get_fingerprint(feather_path):
+    """Size and modification time of the indexed feather; any rewrite changes it."""
+    stat = os.stat(feather_path)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+def build_index(feather_path, num_targets, index_path=None, chunk_size=5_000_000):
+    """
+    Builds the persistent hash index (key -> row number) for a dataset or results feather.
+    Rows of dataset.feather are already canonical, so they are hashed as they are.
+    The feather is read in slices, and its fingerprint is saved next to the index.
+    """
+    index_path = index_path or get_index_path(feather_path)
+    z_cols = [f"z{i}" for i in range(num_targets)]
+
+    scan = pl.scan_ipc(feather_path).select(z_cols)
+    total_rows = scan.select(pl.len()).collect().item()
+    keys = []
+    rows = []
+    with tqdm(total=total_rows, desc="Indexing", unit="struct") as pbar:
+        for offset in range(0, total_rows, chunk_size):
+            chunk = scan.slice(offset, chunk_size).collect()
+            keys.append(pattern_keys(chunk.to_numpy()))
+            rows.append(np.arange(offset, offset + len(chunk), dtype=np.uint64))
+            pbar.update(len(chunk))
+
+    index = pl.DataFrame({
+        "key": np.concatenate(keys) if keys else np.array([], dtype=np.uint64),
+        "row": np.concatenate(rows) if rows else np.array([], dtype=np.uint64),
+    }).sort("key")
+    index.write_ipc(index_path)
+    with open(f"{index_path}.json", "w") as f:
+        json.dump(get_fingerprint(feather_path), f)
+    print(f"Saved index of {len(index)} structures to {index_path}")
+    return index
+
+def load_index(feather_path, num_targets, index_path=None):
+    """Loads the index, rebuilding it when missing or built from a different version of the feather."""
+    index_path = index_path or get_index_path(feather_path)
+    fingerprint_path = f"{index_path}.json"
+    if os.path.exists(index_path) and os.path.exists(fingerprint_path):
+        with open(fingerprint_path, "r") as f:
+            fingerprint = json.load(f)
+        if fingerprint == get_fingerprint(feather_path):
+            return pl.read_ipc(index_path)
+        print(f"Index {index_path} was built from a different {feather_path}. Rebuilding...")
+    return build_index(feather_path, num_targets, index_path)
+
+def lookup_patterns(patterns, feather_path, p_invs, num_targets, index_path=None):
+    """
+    Joins arbitrary substitution patterns to their symmetry-unique rows of feather_path.
+    Returns the input patterns with the matched "row" and the feather's non-z columns
+    (null when the canonical pattern is not in the dataset).
+    Only the candidate rows are read from the feather.
+    """
+    z_cols = [f"z{i}" for i in range(num_targets)]
+    if isinstance(patterns, pl.DataFrame):
+        patterns = patterns.select(z_cols).to_numpy()
+    patterns = np.asarray(patterns, dtype=np.int8)
+
+    canonical = canonicalize_patterns(patterns, p_invs)
+    queries = pl.DataFrame({
+        "query": np.arange(len(patterns), dtype=np.uint64),
+        "key": pattern_keys(canonical),
+    })
+    index = load_index(feather_path, num_targets, index_path)
+    candidates = queries.join(index, on="key", how="inner")
+
+    stored = (
+        pl.scan_ipc(feather_path)
+        .with_row_index("row")
+        .with_columns(pl.col("row").cast(pl.UInt64))
+        .filter(pl.col("row").is_in(candidates["row"].unique().implode()))
+        .collect()
+    )
+    candidates = candidates.join(stored, on="row", how="inner")
+
+    # Hash collisions are resolved by comparing the stored row with the canonical pattern
+    query_idx = candidates["query"].to_numpy().astype(np.intp)
+    same = (candidates.select(z_cols).to_numpy() == canonical[query_idx]).all(axis=1) \
+        if len(candidates) else np.zeros(0, dtype=bool)
+
+    value_cols = [c for c in stored.columns if c not in z_cols and c != "row"]
+    matches = (
+        candidates.filter(pl.Series(same))
+        .select(["query", "row"] + value_cols)
+        .unique(subset="query", keep="first", maintain_order=True)
+    )
+
+    result = pl.DataFrame(patterns.astype(np.int64), schema=z_cols).with_columns(
+        pl.Series("query", np.arange(len(patterns), dtype=np.uint64))
+    )
+    result = result.join(matches, on="query", how="left").sort("query").drop("query")
+    print(f"Matched {result['row'].is_not_null().sum()}/{len(result)} patterns to {feather_path}")
+    return result
+
+def main():
+    import argparse
+    from .symmetry import get_permutations_target_atoms
+    parser = argparse.ArgumentParser(description="Map substitution patterns to symmetry-unique dataset rows")
+    parser.add_argument("patterns", help="Feather or CSV file with z0..zn columns")
+    parser.add_argument("--data", default="results_final.feather")
+    parser.add_argument("--out", default="lookup.feather")
+    parser.add_argument("--index", help="Index file (default: <data>_index.feather)")
+    args = parser.parse_args()
+
+    if not os.path.exists(".config.json"):
+        print("Error: .config.json not found. Run the pipeline first.")
+        return
+    with open(".config.json", "r") as f:
+        config = json.load(f)
+
+    _, p_invs, _ = get_permutations_target_atoms(config["reference_file"], config["target_indices"])
+    if args.patterns.endswith(".csv"):
+        patterns = pl.read_csv(args.patterns)
+    else:
+        patterns = pl.read_ipc(args.patterns)
+
+    result = lookup_patterns(patterns, args.data, p_invs, config["num_target_atoms"], args.index)
+    result.write_ipc(args.out)
+    print(f"Saved {len(result)} rows to {args.out}")
+
+if __name__ == "__main__":
+    main()
@@ -10,8 +10,10 @@ import pickle
 import nablachem.alchemy
 from tqdm import tqdm
 from multiprocessing import Pool
-from .symmetry import get_permutations_all_atoms, get_permutations_target_atoms, get_pet_count, get_pet_counts_by_k
+from .symmetry import get_permutations_all_atoms, get_permutations_target_atoms, get_pet_count, get_pet_counts_by_k, get_pet_counts_by_colors, get_stabilizer_chain, get_coset_checks
 from .results import extract_all
+from .constraints import get_target_neighbors, get_forbidden_pairs, get_constrained_counts_by_k, is_feasible, violates_neighbors, constraints_from_args
+from .state import load_state, make_phase, run_phase, explain, hash_file, hash_directory, hash_code
 from pymatgen.core import Molecule
 
 def get_atom_types(xyz_file):
@@ -66,29 +68,67 @@ def is_partial_canonical(pos, current_struct, p_invs):
                 break # This permutation makes the image larger, so it's safe.
     return True
 
-def generate_prediction_set(config, perms, p_invs, max_subs):
-    """Generates all unique structures up to max_subs using backtracking and pruning."""
+def augment_partial_canonical(pos, current_struct, live, coset_checks):
+    """
+    Canonical augmentation step: same verdict as is_partial_canonical, but only the
+    group elements whose image still ties the prefix (the stabilizer of the partial
+    coloring) are tested. live holds (p_inv, j) pairs, j being the first undecided position.
+    Returns (is_canonical, live_for_children, number_of_tests).
+    """
+    # Coset representatives from the stabilizer chain reject cheaply
+    val_pos = current_struct[pos]
+    for i in coset_checks[pos]:
+        if val_pos < current_struct[i]:
+            return False, None, len(coset_checks[pos])
+
+    tests = len(coset_checks[pos])
+    next_live = []
+    for p_inv, j in live:
+        tests += 1
+        larger = False
+        while j <= pos:
+            source_idx = p_inv[j]
+            if source_idx > pos:
+                break
+            val_image = current_struct[source_idx]
+            val_orig = current_struct[j]
+            if val_image < val_orig:
+                return False, None, tests
+            if val_image > val_orig:
+                larger = True
+                break
+            j += 1
+        if not larger:
+            next_live.append((p_inv, j))
+    return True, next_live, tests
+
+def generate_prediction_set(config, perms, p_invs, max_subs, use_chain=False, constraints=None, colors=None):
+    """
+    Generates all unique structures up to max_subs using backtracking and pruning.
+    With use_chain, partial canonicity is decided by canonical augmentation on the
+    stabilizer chain instead of scanning the whole group at every depth.
+    constraints (see constraints_from_args) prune branches that cannot end inside the
+    charge window, the per-color count limits or the forbidden-neighbor rules.
+    colors is the substitution alphabet (nuclear charge changes, 0 = reference atom).
+    """
     print(f"Generating prediction set (up to {max_subs} substitutions) using backtracking...")
     num_targets = config["num_target_atoms"]
     output_temp = "dataset_temp.csv"
     z_cols = [f"z{i}" for i in range(num_targets)]
-    
-    theoretical_counts = get_pet_counts_by_k(perms, num_targets, max_subs)
-    total_theoretical = sum(theoretical_counts.values()) + 1 # +1 for reference k=0
-    
-    # Check if dataset.feather exists
-    output_feather = "dataset.feather"
-    if os.path.exists(output_feather):
-        try:
-            count = pl.scan_ipc(output_feather).select(pl.len()).collect().item()
-            if count > 0:
-                print(f"{output_feather} found with {count} structures. Skipping generation (theoretical max: {total_theoretical}).")
-                if os.path.exists(output_temp):
-                    os.remove(output_temp)
-                    print(f"Removed temporary file {output_temp}.")
-                return
-        except Exception as e:
-            print(f"Error checking {output_feather}: {e}")
+    colors = sorted(set(colors or config.get("colors", [-1, 0, 1])) | {0})
+    if constraints and colors != [-1, 0, 1]:
+        raise ValueError(f"Enumeration constraints only support the colors [-1, 0, 1], got {colors}.")
+
+    if constraints:
+        print(f"Enumeration constraints: {constraints}")
+        color_counts = get_pet_counts_by_colors(perms, max_subs)
+        theoretical_counts = get_constrained_counts_by_k(color_counts, constraints, max_subs)
+    else:
+        theoretical_counts = get_pet_counts_by_k(perms, num_targets, max_subs, len(colors) - 1)
+    # The unsubstituted reference (k=0) is only part of the dataset if it satisfies the constraints
+    include_reference = not constraints or is_feasible(constraints, 0, 0, 0)
+    total_theoretical = sum(theoretical_counts.get(k, 0) for k in range(1, max_subs + 1)) + int(include_reference)
+
 
     import csv
     existing_counts = {}
@@ -98,7 +138,7 @@ def generate_prediction_set(config, perms, p_invs, max_subs):
             # Use lazy scan to get counts per k without loading whole file
             q = (
                 pl.scan_csv(output_temp)
-                .select(pl.sum_horizontal(pl.all().abs()).alias("k"))
+                .select(pl.sum_horizontal(pl.all() != 0).alias("k"))
                 .group_by("k")
                 .len()
             )
@@ -110,20 +150,53 @@ def generate_prediction_set(config, perms, p_invs, max_subs):
             print(f"Error checking resume point: {e}")
 
     # Open CSV in append mode
-    file_exists = os.path.exists(output_temp)
+    file_empty = not os.path.exists(output_temp) or os.path.getsize(output_temp) == 0
     csv_file = open(output_temp, "a", newline='')
     writer = csv.DictWriter(csv_file, fieldnames=z_cols)
-    if not file_exists or 0 not in existing_counts:
+    if file_empty:
         writer.writeheader()
+    if include_reference and 0 not in existing_counts:
         # Reference (k=0)
         writer.writerow({f"z{i}": 0 for i in range(num_targets)})
         existing_counts[0] = 1
-        csv_file.flush()
+    csv_file.flush()
 
     total_unique_found = sum(existing_counts.values())
-    
+
+    # Canonicity statistics: nodes visited and permutation tests performed
+    stats = {"nodes": 0, "tests": 0}
+    if use_chain:
+        chain = get_stabilizer_chain(p_invs, num_targets)
+        coset_checks = get_coset_checks(chain, num_targets)
+        identity = list(range(num_targets))
+        root_live = [(p_inv, 0) for p_inv in p_invs if list(p_inv) != identity]
+        print(f"Stabilizer chain: {len(chain)} levels, orbit sizes {[len(t) for t in chain]}.")
+    else:
+        root_live = None
+
+    forbidden = get_forbidden_pairs(constraints) if constraints else set()
+    if forbidden:
+        neighbors = get_target_neighbors(config["reference_file"], config["target_indices"],
+                                         constraints.get("bond_tolerance", 0.2))
+
+    def allowed(idx, current_struct, n_minus, n_plus, k_rem):
+        if not constraints:
+            return True
+        if not is_feasible(constraints, n_minus, n_plus, k_rem):
+            return False
+        return not (forbidden and violates_neighbors(idx, current_struct, neighbors, forbidden))
+
+    def check(idx, current_struct, live):
+        stats["nodes"] += 1
+        if live is None:
+            stats["tests"] += len(p_invs)
+            return is_partial_canonical(idx, current_struct, p_invs), None
+        ok, next_live, tests = augment_partial_canonical(idx, current_struct, live, coset_checks)
+        stats["tests"] += tests
+        return ok, next_live
+
     # We use a recursive generator for each k
-    def backtrack_recursive(idx, current_struct, k_rem):
+    def backtrack_recursive(idx, current_struct, k_rem, live=None, n_minus=0, n_plus=0):
         # Base case: we've assigned all atoms
         if idx == num_targets:
             if k_rem == 0:
@@ -134,19 +207,25 @@ def generate_prediction_set(config, perms, p_invs, max_subs):
         if k_rem > (num_targets - idx):
             return
 
-        # Try colors -1, 0, 1 in that order (lexicographical minimum)
-        for color in [-1, 0, 1]:
+        # Try colors in ascending order (lexicographical minimum)
+        for color in colors:
             if color != 0:
                 if k_rem == 0: continue
                 current_struct[idx] = color
-                if is_partial_canonical(idx, current_struct, p_invs):
-                    yield from backtrack_recursive(idx + 1, current_struct, k_rem - 1)
+                c_minus = n_minus + (color == -1)
+                c_plus = n_plus + (color == 1)
+                if not allowed(idx, current_struct, c_minus, c_plus, k_rem - 1): continue
+                ok, next_live = check(idx, current_struct, live)
+                if ok:
+                    yield from backtrack_recursive(idx + 1, current_struct, k_rem - 1, next_live, c_minus, c_plus)
             else:
                 # color 0
                 current_struct[idx] = 0
-                if is_partial_canonical(idx, current_struct, p_invs):
-                    yield from backtrack_recursive(idx + 1, current_struct, k_rem)
-        
+                if not allowed(idx, current_struct, n_minus, n_plus, k_rem): continue
+                ok, next_live = check(idx, current_struct, live)
+                if ok:
+                    yield from backtrack_recursive(idx + 1, current_struct, k_rem, next_live, n_minus, n_plus)
+
         # Reset for backtracking
         current_struct[idx] = 0
 
@@ -171,7 +250,7 @@ def generate_prediction_set(config, perms, p_invs, max_subs):
             try:
                 k_structs = (
                     pl.scan_csv(output_temp)
-                    .filter(pl.sum_horizontal(pl.all().abs()) == k)
+                    .filter(pl.sum_horizontal(pl.all() != 0) == k)
                     .collect()
                 )
                 for row_vals in k_structs.iter_rows():
@@ -183,19 +262,24 @@ def generate_prediction_set(config, perms, p_invs, max_subs):
         k_count = found_k
         current_struct = [0] * num_targets
         
-        for struct in backtrack_recursive(0, current_struct, k):
+        for struct in backtrack_recursive(0, current_struct, k, root_live):
             if struct not in existing_in_k:
                 writer.writerow({f"z{i}": val for i, val in enumerate(struct)})
                 k_count += 1
                 total_unique_found += 1
                 pbar.update(1)
                 if k_count % 1000 == 0: csv_file.flush()
-                
+
     pbar.close()
     csv_file.close()
-    print(f"Total unique structures in dataset: {total_unique_found}")
+    print(f"Total unique structures in dataset: {total_unique_found} (theoretical max: {total_theoretical})")
+    if use_chain and stats["tests"] > 0:
+        full_scan = stats["nodes"] * len(p_invs)
+        print(f"Canonical augmentation: {stats['tests']} permutation tests over {stats['nodes']} nodes "
+              f"vs {full_scan} for a full scan of |G|={len(p_invs)} (speedup {full_scan / stats['tests']:.1f}x).")
     print(f"Converting to dataset.feather (streaming)...")
-    pl.scan_csv(output_temp).sink_ipc("dataset.feather")
+    # One byte per atom is enough for any substitution alphabet
+    pl.scan_csv(output_temp, schema={c: pl.Int8 for c in z_cols}).sink_ipc("dataset.feather")
     print("Done.")
     
     # Cleanup temporary CSV
@@ -222,8 +306,11 @@ def convert_huge_csv_to_feather(csv_path, feather_path):
     print(f"Tamanho Feather: {feather_size:.2f} GB")
     print("-" * 30)
 
-def run_prediction(training_feather, dataset_feather, config, properties):
-    """Loads training data, builds MultiTaylor model, and predicts for dataset."""
+def build_model(training_feather, config, properties):
+    """
+    Loads training data and builds the MultiTaylor model.
+    Returns it as {"center": {col: value}, "terms": {property: [[coeff, {col: power}], ...]}}.
+    """
     print(f"Building MultiTaylor model from {training_feather}...")
     num_targets = config["num_target_atoms"]
     z_cols = [f"z{i}" for i in range(num_targets)]
@@ -234,24 +321,65 @@ def run_prediction(training_feather, dataset_feather, config, properties):
     mt.reset_center(**{f'z{i}': 0 for i in range(num_targets)})
     mt.build_model(2)
     print("Model built successfully.")
-    
-    print(f"Predicting for structures in {dataset_feather} (vectorized)...")
-    
-    exprs = []
+
+    model = {"center": {col: float(mt._center[col]) for col in z_cols}, "terms": {}}
     for output in properties:
+        model["terms"][output] = [
+            [float(monomial.prefactor()), {col: int(power) for col, power in monomial._powers.items()}]
+            for monomial in mt._monomials[output]
+        ]
+    return model
+
+def build_model_from_derivatives(derivatives_file, config):
+    """Second-order Taylor model of Energy_DFT around the reference from its alchemical derivatives."""
+    print(f"Building Taylor model from alchemical derivatives in {derivatives_file}...")
+    num_targets = config["num_target_atoms"]
+    z_cols = [f"z{i}" for i in range(num_targets)]
+
+    derivs = np.load(derivatives_file)
+    grad, hess = derivs["gradient"], derivs["hessian"]
+    terms = [[float(derivs["energy"]), {}]]
+    for i, col in enumerate(z_cols):
+        terms.append([float(grad[i]), {col: 1}])
+        terms.append([0.5 * float(hess[i, i]), {col: 2}])
+        for j in range(i + 1, num_targets):
+            terms.append([float(hess[i, j]), {col: 1, z_cols[j]: 1}])
+    print("Model built successfully.")
+    return {"center": {col: 0.0 for col in z_cols}, "terms": {"Energy_DFT": terms}}
+
+def save_model(model, filename):
+    with open(filename, "w") as f:
+        json.dump(model, f)
+    print(f"Saved model to {filename}")
+
+def load_model(filename):
+    with open(filename, "r") as f:
+        return json.load(f)
+
+def model_expressions(model):
+    """Turns the model polynomials into vectorized polars expressions, one per property."""
+    exprs = []
+    for output, terms in model["terms"].items():
         poly_expr = pl.lit(0.0)
-        for monomial in mt._monomials[output]:
-            coeff = monomial.prefactor()
-            if not monomial._powers:
+        for coeff, powers in terms:
+            if not powers:
                 poly_expr = poly_expr + coeff
             else:
                 term_expr = pl.lit(coeff)
-                for col, power in monomial._powers.items():
-                    center_val = mt._center[col]
+                for col, power in powers.items():
+                    center_val = model["center"][col]
                     term_expr = term_expr * ((pl.col(col) - center_val) ** power)
                 poly_expr = poly_expr + term_expr
         exprs.append(poly_expr.alias(output))
-    
+    return exprs
+
+def predict_dataset(exprs, dataset_feather):
+    """
+    Evaluates the model expressions over the dataset in chunks and writes results_final.feather.
+    Returns True if the written feather has one row per dataset structure.
+    """
+    print(f"Predicting for structures in {dataset_feather} (vectorized)...")
+
     output_feather = "results_final.feather"
     output_csv = "results_temp.csv"
     
@@ -285,11 +413,12 @@ def run_prediction(training_feather, dataset_feather, config, properties):
             print(f"Verification successful: {count_feather} rows in Feather matches dataset.")
             os.remove(output_csv)
             print(f"Removed temporary file {output_csv}.")
-        else:
-            print(f"Warning: Row count mismatch! Feather: {count_feather}, Expected: {total_rows}")
-            print(f"Temporary file {output_csv} retained for inspection.")
+            return True
+        print(f"Warning: Row count mismatch! Feather: {count_feather}, Expected: {total_rows}")
+        print(f"Temporary file {output_csv} retained for inspection.")
     except Exception as e:
         print(f"Error during verification: {e}")
+    return False
 
 def write_auto_orca_script(directory):
     script_path = os.path.join(directory, "auto_orca.sh")
@@ -360,32 +489,70 @@ done
         f.write(content)
     os.chmod(script_path, 0o755)
 
+def iter_color_counts(k, num_colors):
+    """Yields every way to split k substitutions over num_colors colors, in ascending order."""
+    if num_colors == 1:
+        yield (k,)
+        return
+    for first in range(k + 1):
+        for rest in iter_color_counts(k - first, num_colors - 1):
+            yield (first,) + rest
+
+def iter_substitutions(num_targets, nonzero_colors, k):
+    """Yields every pattern with exactly k substituted atoms (no symmetry reduction)."""
+    for counts in iter_color_counts(k, len(nonzero_colors)):
+        def place(color_idx, remaining, struct):
+            if color_idx == len(nonzero_colors):
+                yield list(struct)
+                return
+            for idxs in itertools.combinations(remaining, counts[color_idx]):
+                for i in idxs: struct[i] = nonzero_colors[color_idx]
+                rest = [i for i in remaining if i not in idxs]
+                yield from place(color_idx + 1, rest, struct)
+                for i in idxs: struct[i] = 0
+        yield from place(0, list(range(num_targets)), [0] * num_targets)
+
 def phase_setup_training(args):
     atom_types, all_species = get_atom_types(args.reference)
     print(f"Atom types present: {', '.join(atom_types)}")
     
     target_type = args.atom
-    if not target_type:
-         target_type = input(f"Which atom type to substitute? ({'/'.join(atom_types)}): ")
-    
-    if target_type not in atom_types:
-        print(f"Error: {target_type} not in molecule.")
-        sys.exit(1)
-
-    target_indices = [i for i, s in enumerate(all_species) if s == target_type]
+    # Several comma-separated types (e.g. C,N) substitute mixed-element targets
+    target_types = target_type.split(",")
+    for t in target_types:
+        if t not in atom_types:
+            print(f"Error: {t} not in molecule.")
+            sys.exit(1)
+
+    target_indices = [i for i, s in enumerate(all_species) if s in target_types]
     print(f"Found {len(target_indices)} atoms of type {target_type}.")
 
+    colors = sorted(set(args.colors) | {0})
+    nonzero_colors = [c for c in colors if c != 0]
+    pt, inv_pt = get_atomic_number_map()
+    for t in target_types:
+        missing = [c for c in nonzero_colors if pt[t] + c not in inv_pt]
+        if missing:
+            print(f"Error: substitutions {missing} of {t} are outside the periodic table map.")
+            sys.exit(1)
+        subs = " or ".join(f"{inv_pt[pt[t] + c]}({c:+d})" for c in nonzero_colors)
+        print(f"Substitutions: {t} -> {subs}")
+
     # Symmetry
     # All-atom permutations for accurate total PET count
     perms_all, _, pg_symbol = get_permutations_all_atoms(args.reference, target_indices)
-    total_unique_all_subs = get_pet_count(perms_all, 3) 
+    total_unique_all_subs = get_pet_count(perms_all, len(colors))
     print(f"Total theoretically unique structures (all possible substitutions): {total_unique_all_subs}")
 
+    # Reference atomic number of every target atom, z-values are offsets from it
+    target_z = [pt[all_species[i]] for i in target_indices]
 
     config = {
         "reference_file": args.reference,
         "target_type": target_type,
         "target_indices": target_indices,
+        "target_z": target_z,
+        "colors": colors,
         "symmetry_pg": pg_symbol,
         "initial_charge": args.charge,
         "num_target_atoms": len(target_indices)
@@ -394,14 +561,15 @@ def phase_setup_training(args):
     with open(".config.json", "w") as f:
         json.dump(config, f, indent=4)
 
-    pt, inv_pt = get_atomic_number_map()
-    target_z = pt[target_type]
-    sub_minus_type = inv_pt[target_z - 1]
-    sub_plus_type = inv_pt[target_z + 1]
-    
-    print(f"Substitutions: {target_type} -> {sub_minus_type}(-1) or {sub_plus_type}(+1)")
+    if args.derivatives:
+        print("Derivative mode: no training structures needed, the model comes from the reference alone.")
+        return True
 
+    # Only the structure files are replaced; ORCA jobs in training_inputs/run/ are kept
     os.makedirs("training_inputs", exist_ok=True)
+    for f in os.listdir("training_inputs"):
+        if f.startswith("struct_") and f.endswith(".xyz"):
+            os.remove(os.path.join("training_inputs", f))
     mol = Molecule.from_file(args.reference)
     coords = mol.cart_coords
     
@@ -410,26 +578,15 @@ def phase_setup_training(args):
     
     for k in range(1, args.subs + 1):
         k_count = 0
-        for num_minus in range(k + 1):
-            num_plus = k - num_minus
-            charge_delta = num_plus - num_minus
-            
-            for minus_idxs in itertools.combinations(range(len(target_indices)), num_minus):
-                remaining = [i for i in range(len(target_indices)) if i not in minus_idxs]
-                for plus_idxs in itertools.combinations(remaining, num_plus):
-                    struct = [0] * len(target_indices)
-                    for i in minus_idxs: struct[i] = -1
-                    for i in plus_idxs: struct[i] = 1
-                    
-                    training_structs.append((struct, charge_delta))
-                    k_count += 1
+        for struct in iter_substitutions(len(target_indices), nonzero_colors, k):
+            training_structs.append((struct, sum(struct)))
+            k_count += 1
         print(f"k={k}: {k_count} structures.")
 
     for idx, (struct, charge_delta) in enumerate(training_structs):
         new_species = list(all_species)
         for i, val in enumerate(struct):
-            if val == -1: new_species[target_indices[i]] = sub_minus_type
-            elif val == 1: new_species[target_indices[i]] = sub_plus_type
+            if val != 0: new_species[target_indices[i]] = inv_pt[target_z[i] + val]
         
         final_charge = args.charge + charge_delta
         filename = f"training_inputs/struct_{idx:04d}_q{final_charge}.xyz"
@@ -437,53 +594,154 @@ def phase_setup_training(args):
 
     write_auto_orca_script("training_inputs")
     print(f"Done. {len(training_structs)} training files generated in 'training_inputs/'.")
-    print("Next: Run 'training_inputs/auto_orca.sh' and then run this script again.")
+    if args.backend == "orca":
+        print("Next: Run 'training_inputs/auto_orca.sh' and then run this script again.")
+    return True
+
+def get_setup_phase(args):
+    """The training setup (.config.json and training_inputs/), keyed by the command line that defines it."""
+    return make_phase(
+        "setup", [".config.json"] + ([] if args.derivatives else ["training_inputs"]),
+        reference_file=args.reference, reference=hash_file(args.reference), target_type=args.atom,
+        colors=sorted(set(args.colors) | {0}), subs=None if args.derivatives else args.subs,
+        charge=args.charge, code=hash_code(phase_setup_training, iter_substitutions, iter_color_counts))
+
+SYMMETRY_FILE = ".symmetry.json"
+
+def run_symmetry(config):
+    perms, p_invs, pg = get_permutations_target_atoms(config["reference_file"], config["target_indices"])
+    with open(SYMMETRY_FILE, "w") as f:
+        json.dump({"perms": [[int(i) for i in p] for p in perms],
+                   "p_invs": [[int(i) for i in p] for p in p_invs],
+                   "point_group": pg}, f)
+    return True
+
+def load_symmetry():
+    with open(SYMMETRY_FILE, "r") as f:
+        data = json.load(f)
+    return data["perms"], data["p_invs"], data["point_group"]
+
+def get_phases(config, args, setup):
+    """
+    The pipeline DAG: setup -> symmetry -> enumeration, setup -> extraction -> model,
+    both -> prediction. Each phase is keyed by its inputs, parameters and the code it runs.
+    """
+    from . import symmetry as symmetry_module, constraints as constraints_module, results as results_module
+    targets = {k: config.get(k) for k in ("target_indices", "target_z", "initial_charge")}
+
+    symmetry = make_phase(
+        "symmetry", [SYMMETRY_FILE], [setup],
+        reference=hash_file(config["reference_file"]), targets=targets,
+        code=hash_code(symmetry_module))
+    # The stabilizer-chain mode (-g) gives identical output and is not part of the key
+    enumeration = make_phase(
+        "enumeration", ["dataset.feather"], [setup, symmetry], temporaries=["dataset_temp.csv"],
+        max_subs=config.get("num_target_atoms", 20), colors=config.get("colors", [-1, 0, 1]),
+        constraints=constraints_from_args(args),
+        code=hash_code(generate_prediction_set, is_partial_canonical, augment_partial_canonical,
+                       symmetry_module, constraints_module))
+
+    if args.derivatives:
+        from . import pyscf_backend
+        props = ["Energy_DFT"]
+        extraction = make_phase(
+            "extraction", ["derivatives.npz"], [setup],
+            reference=hash_file(config["reference_file"]), targets=targets,
+            xc=args.xc, basis=args.basis, code=hash_code(pyscf_backend))
+        model_code = hash_code(build_model_from_derivatives)
+    elif args.backend == "pyscf":
+        from . import pyscf_backend
+        props = args.props
+        # The SCF guess only changes the starting point, not the converged results
+        extraction = make_phase(
+            "extraction", ["training.feather"], [setup],
+            training_inputs=hash_directory("training_inputs", ".xyz"), targets=targets,
+            props=props, xc=args.xc, basis=args.basis, code=hash_code(pyscf_backend, results_module))
+        model_code = hash_code(build_model)
+    else:
+        props = args.props
+        extraction = make_phase(
+            "extraction", ["training.feather"], [setup],
+            training_outputs=hash_directory("training_outputs", ".out"), targets=targets,
+            props=props, code=hash_code(results_module))
+        model_code = hash_code(build_model)
+
+    model = make_phase("model", ["model.json"], [extraction], props=props, code=model_code)
+    prediction = make_phase(
+        "prediction", ["results_final.feather"], [enumeration, model],
+        code=hash_code(model_expressions, predict_dataset, convert_huge_csv_to_feather))
+    return [setup, symmetry, enumeration, extraction, model, prediction]
+
+def phase_extract_predict(config, args, state, setup):
+    _, symmetry, enumeration, extraction, model, prediction = get_phases(config, args, setup)
+    force = args.recalculate
+    trust = args.trust_existing
+
+    if not run_phase(state, symmetry, lambda: run_symmetry(config), force, trust):
+        return True
+    perms, p_invs, pg = load_symmetry()
+
+    def run_enumeration():
+        generate_prediction_set(config, perms, p_invs, config.get("num_target_atoms", 20), args.chain, constraints_from_args(args), config.get("colors"))
+        return os.path.exists("dataset.feather")
 
-def phase_extract_predict(config, perms, p_invs, args):
     if args.structures:
-        generate_prediction_set(config, perms, p_invs, config.get("num_target_atoms", 20))
+        run_phase(state, enumeration, run_enumeration, force, trust)
         print("Workflow: Structure generation complete.")
         return True
 
-    if not os.path.exists("training_inputs"):
-        print("Workflow: 'training_inputs/' directory not found. Re-generating training set...")
-        # We need to re-run the setup phase logic or similar. 
-        # For simplicity, let's signal to main to proceed to setup.
-        return False
+    props = args.props
+
+    if args.derivatives:
+        if props != ["Energy_DFT"]:
+            print("Workflow: Derivative mode only predicts Energy_DFT.")
+        from .pyscf_backend import run_derivatives
+        if not run_phase(state, extraction, lambda: run_derivatives(config, "derivatives.npz", xc=args.xc, basis=args.basis, workers=args.workers), force, trust):
+            return True
+        build = lambda: build_model_from_derivatives("derivatives.npz", config)
+    else:
+        num_inputs = len([f for f in os.listdir("training_inputs") if f.endswith(".xyz")])
+        if args.backend == "pyscf":
+            from .pyscf_backend import run_training
+            def extract():
+                print(f"Workflow: {num_inputs} training calculations run in-process with PySCF.")
+                return run_training("training_inputs", "training.feather", config, props,
+                                    xc=args.xc, basis=args.basis, workers=args.workers, guess=args.scf_guess) is not None
+        else:
+            if not os.path.exists("training_outputs"):
+                print(f"Workflow: 'training_outputs/' not found. Please run calculations first.")
+                return True
+
+            num_outputs = len([f for f in os.listdir("training_outputs") if f.endswith(".out")])
+            print(f"Workflow: {num_outputs}/{num_inputs} calculations complete.")
+
+            if num_outputs < num_inputs:
+                print("Workflow: Waiting for all calculations to complete.")
+                return True
+
+            from .results import extract_all
+            extract = lambda: extract_all("training_outputs", "training.feather", config, props) is not None
 
-    num_inputs = len([f for f in os.listdir("training_inputs") if f.endswith(".xyz")])
-    if num_inputs == 0:
-        print("Workflow: 'training_inputs/' is empty. Re-generating training set...")
-        return False
+        if not run_phase(state, extraction, extract, force, trust):
+            return True
+        build = lambda: build_model("training.feather", config, props)
 
-    if not os.path.exists("training_outputs"):
-        print(f"Workflow: 'training_outputs/' not found. Please run calculations first.")
+    if not run_phase(state, enumeration, run_enumeration, force, trust):
         return True
-        
-    num_outputs = len([f for f in os.listdir("training_outputs") if f.endswith(".out")])
-    print(f"Workflow: {num_outputs}/{num_inputs} calculations complete.")
-    
-    if num_outputs < num_inputs:
-        print("Workflow: Waiting for all calculations to complete.")
-        return
 
-    print("Workflow: All training calculations complete. Proceeding to dataset generation.")
-    generate_prediction_set(config, perms, p_invs, config.get("num_target_atoms", 20)) 
-    
-    print("Workflow: Proceeding to property extraction.")
-    #props = input("Properties to extract (space separated, default: Energy model): ")
-    if not props: props = ["Energy model"]
-    else: props = props.split()
-    
-    from .results import extract_all
-    df_train = extract_all("training_outputs", "training.feather", config, props)
-    
-    if df_train is not None:
-        if args.recalculate or not os.path.exists("results_final.feather"):
-            run_prediction("training.feather", "dataset.feather", config, props)
-            print("Workflow: Extraction and prediction complete.")
-        else:
-            print("Workflow: Prediction already exists. Use -r to recalculate.")
+    def run_model():
+        save_model(build(), "model.json")
+        return True
+
+    if not run_phase(state, model, run_model, force, trust):
+        return True
+
+    def run_predict():
+        return predict_dataset(model_expressions(load_model("model.json")), "dataset.feather")
+
+    if run_phase(state, prediction, run_predict, force, trust):
+        print("Workflow: Pipeline complete.")
+    return True
 
 def main():
     parser = argparse.ArgumentParser(description="Quantum Alchemy Pipeline")
@@ -492,26 +750,74 @@ def main():
     parser.add_argument("-a", "--atom", help="Atom type to substitute (e.g., C)")
     parser.add_argument("-p", "--pipeline", action="store_true", help="Run the full pipeline (default)")
     parser.add_argument("-s", "--structures", action="store_true", help="Generate unique structures only")
-    parser.add_argument("-r", "--recalculate", action="store_true", help="Force recalculate results (debug)")
+    parser.add_argument("-r", "--recalculate", action="store_true", help="Force recalculation of every phase (debug)")
+    parser.add_argument("--trust-existing", action="store_true", help="Adopt existing outputs of phases without a recorded state instead of recomputing them")
+    parser.add_argument("-e", "--explain", action="store_true", help="Show which phases would run and why, then exit")
+    parser.add_argument("-g", "--chain", action="store_true", help="Use stabilizer-chain canonical augmentation for structure generation")
+    parser.add_argument("--charge-window", type=int, nargs=2, metavar=("MIN", "MAX"), help="Allowed net charge change of the generated structures")
+    parser.add_argument("--count-limit", type=int, nargs=3, action="append", metavar=("COLOR", "MIN", "MAX"), help="Allowed number of atoms with substitution COLOR (-1 or 1), repeatable")
+    parser.add_argument("--forbid-adjacent", type=int, nargs=2, action="append", metavar=("A", "B"), help="Forbid bonded target atoms with substitutions A and B, repeatable")
+    parser.add_argument("--bond-tol", type=float, default=0.2, help="Bond length tolerance for --forbid-adjacent (default: 0.2)")
+    parser.add_argument("--colors", type=int, nargs="+", default=[-1, 0, 1], help="Substitution alphabet as nuclear charge changes (default: -1 0 1)")
     parser.add_argument("-k", "--subs", type=int, default=2, help="Max substitutions for training (default: 2)")
+    parser.add_argument("--props", nargs="+", default=["Energy_DFT"], help="Properties to extract and predict (default: Energy_DFT)")
+    parser.add_argument("-b", "--backend", choices=["orca", "pyscf"], default="orca", help="Training calculations: ORCA inputs to run externally, or in-process PySCF (default: orca)")
+    parser.add_argument("-d", "--derivatives", action="store_true", help="Build the model from alchemical derivatives of the reference (PySCF) instead of training calculations")
+    parser.add_argument("--xc", default="B3LYP", help="Functional for the PySCF backend (default: B3LYP)")
+    parser.add_argument("--basis", default="def2-TZVPP", help="Basis set for the PySCF backend (default: def2-TZVPP)")
+    parser.add_argument("--scf-guess", choices=["minao", "reference"], default="minao", help="Initial SCF guess for the PySCF backend: atomic or the converged reference density (default: minao)")
+    parser.add_argument("--workers", type=int, help="Worker processes for the PySCF backend (default: all cores)")
     args = parser.parse_args()
 
     if not os.path.exists(args.reference):
         print(f"Error: {args.reference} not found.")
         sys.exit(1)
 
+    # Count limits are only enforced for the -1/+1 substitutions
+    for color, _, _ in args.count_limit or []:
+        if color not in (-1, 1):
+            print(f"Error: --count-limit only supports colors -1 and 1 (got {color}).")
+            sys.exit(1)
+    if constraints_from_args(args) and sorted(set(args.colors) | {0}) != [-1, 0, 1]:
+        print("Error: --charge-window, --count-limit and --forbid-adjacent only support --colors -1 0 1.")
+        sys.exit(1)
+
+    config = None
     if os.path.exists(".config.json"):
         with open(".config.json", "r") as f:
             config = json.load(f)
-        
-        if config["reference_file"] == args.reference:
-            target_indices = config["target_indices"]
-            perms, p_invs, pg = get_permutations_target_atoms(args.reference, target_indices)
-            if phase_extract_predict(config, perms, p_invs, args):
-                return
 
-    # Phase 1: Setup Training
-    phase_setup_training(args)
+    # Reruns keep the substituted atom type of the existing setup unless -a is given
+    if not args.atom and config and config["reference_file"] == args.reference:
+        args.atom = config["target_type"]
+
+    state = load_state()
+
+    if args.explain:
+        print("Workflow: Phase plan")
+        if not args.atom:
+            print("  setup: needs -a (atom type to substitute)")
+            return
+        setup = get_setup_phase(args)
+        explain(state, [setup])
+        if config:
+            explain(state, get_phases(config, args, setup)[1:], args.recalculate)
+        else:
+            print("  remaining phases: planned after setup")
+        return
+
+    if not args.atom:
+        atom_types, _ = get_atom_types(args.reference)
+        args.atom = input(f"Which atom type to substitute? ({'/'.join(atom_types)}): ")
+    setup = get_setup_phase(args)
+
+    # Phase 1: Setup Training, then everything downstream of it.
+    # -r recalculates results only, the training inputs (and ORCA runs) are kept.
+    if not run_phase(state, setup, lambda: phase_setup_training(args), trust_existing=args.trust_existing):
+        return
+    with open(".config.json", "r") as f:
+        config = json.load(f)
+    phase_extract_predict(config, args, state, setup)
 
 if __name__ == "__main__":
     main()
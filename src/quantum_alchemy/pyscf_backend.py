@@ -0,0 +1,211 @@
+import os
+import numpy as np
+from tqdm import tqdm
+from multiprocessing import Pool
+from pyscf import gto, dft, lib
+from pyscf.data.nist import HARTREE2EV
+from .results import write_training_feather
+
+# Per-worker settings, filled once by the pool initializer
+_worker = {}
+
+def read_xyz(filename):
+    """Reads an xyz file. Returns the atoms and the comment line."""
+    with open(filename, "r") as f:
+        lines = f.read().splitlines()
+    num_atoms = int(lines[0])
+    atoms = []
+    for line in lines[2:2 + num_atoms]:
+        s, x, y, z = line.split()[:4]
+        atoms.append((s, (float(x), float(y), float(z))))
+    return atoms, lines[1]
+
+def build_mol(atoms, charge, basis):
+    """Builds the PySCF molecule; odd electron counts get a doublet."""
+    nelectron = sum(gto.charge(s) for s, _ in atoms) - charge
+    return gto.M(atom=atoms, charge=charge, spin=nelectron % 2, basis=basis, unit="Angstrom", verbose=0)
+
+def make_scf(mol, xc):
+    mf = dft.RKS(mol) if mol.spin == 0 else dft.UKS(mol)
+    mf.xc = xc
+    return mf
+
+def get_properties(mf, properties):
+    """Energy and frontier orbital energies in eV, same units as the cclib extraction."""
+    row = {}
+    mo_energy = mf.mo_energy
+    mo_occ = mf.mo_occ
+    if mf.mol.spin != 0:
+        # Alpha channel, as cclib's homos[0]
+        mo_energy, mo_occ = mo_energy[0], mo_occ[0]
+    if "Energy_DFT" in properties:
+        row["Energy_DFT"] = mf.e_tot * HARTREE2EV
+    if "HOMO" in properties:
+        row["HOMO"] = mo_energy[mo_occ > 0].max() * HARTREE2EV
+    if "LUMO" in properties:
+        row["LUMO"] = mo_energy[mo_occ == 0].min() * HARTREE2EV
+    return row
+
+def run_reference(reference_xyz, charge, xc, basis):
+    """Converges the reference molecule and returns its density matrix."""
+    atoms, _ = read_xyz(reference_xyz)
+    mf = make_scf(build_mol(atoms, charge, basis), xc)
+    mf.kernel()
+    print(f"Reference SCF: E = {mf.e_tot:.8f} Eh, converged: {mf.converged}, cycles: {getattr(mf, 'cycles', '?')}")
+    return mf.make_rdm1()
+
+def _init_worker(dm0, xc, basis, properties, threads):
+    lib.num_threads(threads)
+    _worker.update(dm0=dm0, xc=xc, basis=basis, properties=properties)
+
+def run_structure(filename):
+    try:
+        # save_xyz writes the charge as the comment line, e.g. "Charge: -1"
+        atoms, comment = read_xyz(filename)
+        charge = int(comment.split()[-1])
+        mol = build_mol(atoms, charge, _worker["basis"])
+        mf = make_scf(mol, _worker["xc"])
+
+        # The reference density is a valid guess whenever the AO basis keeps its size;
+        # training structures keep the electron count, so only the nuclei differ.
+        dm0 = _worker["dm0"]
+        if dm0 is not None and (dm0.shape[-1] != mol.nao_nr() or dm0.ndim != (3 if mol.spin else 2)):
+            dm0 = None
+        mf.kernel(dm0=dm0)
+        if not mf.converged:
+            return {"status": "error", "filename": filename, "error": "SCF not converged"}
+    except Exception as e:
+        return {"status": "error", "filename": filename, "error": str(e)}
+
+    row = {"filename": os.path.basename(filename)}
+    row.update(get_properties(mf, _worker["properties"]))
+    row["SCF_cycles"] = getattr(mf, "cycles", None)
+    return {"status": "ok", "filename": filename, "row": row, "atomnos": mol.atom_charges()}
+
+def run_training(directory, output_feather, config, properties=["Energy_DFT"],
+                 xc="B3LYP", basis="def2-TZVPP", workers=None, threads=1, guess="minao"):
+    """
+    Runs every training structure in directory through PySCF in a process pool and writes
+    the results straight to output_feather (same layout as results.extract_all).
+    With guess="reference" each SCF starts from the converged density of the reference
+    molecule, otherwise from PySCF's default atomic (minao) guess.
+    """
+    xyz_files = sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(".xyz"))
+    if not xyz_files:
+        print("No .xyz files found.")
+        return None
+
+    print(f"Running {len(xyz_files)} PySCF calculations ({xc}/{basis})...")
+    dm0 = None
+    if guess == "reference":
+        dm0 = run_reference(config["reference_file"], config.get("initial_charge", 0), xc, basis)
+
+    workers = workers or max(1, (os.cpu_count() or 1) // threads)
+    with Pool(workers, initializer=_init_worker, initargs=(dm0, xc, basis, properties, threads)) as pool:
+        results = list(tqdm(pool.imap(run_structure, xyz_files), total=len(xyz_files), desc="PySCF training"))
+
+    cycles = [r["row"]["SCF_cycles"] for r in results if r["status"] == "ok" and r["row"]["SCF_cycles"] is not None]
+    if cycles:
+        print(f"Average SCF cycles ({guess} guess): {np.mean(cycles):.1f}")
+    return write_training_feather(results, output_feather, config)
+
+def get_rinv_integrals(mol, atoms):
+    """<mu|1/|r - R_I||nu> for every atom I in atoms (dH/dZ_I = -rinv_I)."""
+    coords = mol.atom_coords()
+    rinv = []
+    for I in atoms:
+        with mol.with_rinv_origin(coords[I]):
+            rinv.append(mol.intor("int1e_rinv"))
+    return rinv
+
+def get_alchemical_gradient(mol, dm, rinv, atoms, dZ=None):
+    """
+    Hellmann-Feynman derivative dE/dZ_I for I in atoms: electronic potential at nucleus I
+    plus the nuclear repulsion term, evaluated with the nuclear charges shifted by dZ.
+    """
+    if dm.ndim == 3:
+        dm = dm[0] + dm[1]
+    coords = mol.atom_coords()
+    charges = mol.atom_charges().astype(float)
+    if dZ is not None:
+        charges = charges + dZ
+    grad = np.zeros(len(atoms))
+    for n, I in enumerate(atoms):
+        dist = np.linalg.norm(coords - coords[I], axis=1)
+        dist[I] = np.inf
+        grad[n] = -np.einsum("ij,ji", rinv[n], dm) + np.sum(charges / dist)
+    return grad
+
+def make_alchemical_scf(mol, xc, rinv, dZ_targets):
+    """SCF with fractional changes dZ_targets of the target nuclear charges in a fixed basis."""
+    mf = make_scf(mol, xc)
+    hcore = mf.get_hcore() - sum(dz * v for dz, v in zip(dZ_targets, rinv))
+    mf.get_hcore = lambda *args: hcore
+    return mf
+
+def _init_derivative_worker(atoms, charge, basis, xc, dm0, target_atoms, conv_tol, threads):
+    lib.num_threads(threads)
+    mol = build_mol(atoms, charge, basis)
+    _worker.update(mol=mol, xc=xc, dm0=dm0, target_atoms=target_atoms, conv_tol=conv_tol,
+                   rinv=get_rinv_integrals(mol, target_atoms))
+
+def run_field(args):
+    """Gradient of the energy after shifting the charge of target n by step."""
+    n, step = args
+    mol, target_atoms, rinv = _worker["mol"], _worker["target_atoms"], _worker["rinv"]
+    dZ_targets = np.zeros(len(target_atoms))
+    dZ_targets[n] = step
+    mf = make_alchemical_scf(mol, _worker["xc"], rinv, dZ_targets)
+    mf.conv_tol = _worker["conv_tol"]
+    mf.kernel(dm0=_worker["dm0"])
+
+    dZ = np.zeros(mol.natm)
+    dZ[target_atoms] = dZ_targets
+    grad = get_alchemical_gradient(mol, mf.make_rdm1(), rinv, target_atoms, dZ)
+    return n, step, grad, mf.converged, getattr(mf, "cycles", None)
+
+def run_derivatives(config, output_file, xc="B3LYP", basis="def2-TZVPP", workers=None, threads=1,
+                    step=0.005, conv_tol=1e-11):
+    """
+    Energy, first and second alchemical derivatives with respect to the target nuclear charges,
+    from one reference SCF. First derivatives are analytical (Hellmann-Feynman), second derivatives
+    are central differences of them under +-step charge fields, run in a process pool starting
+    from the reference density. The basis is kept fixed at the reference.
+    Saved in eV (per unit charge) to output_file as energy/gradient/hessian arrays.
+    """
+    atoms, _ = read_xyz(config["reference_file"])
+    charge = config.get("initial_charge", 0)
+    target_atoms = config["target_indices"]
+    num_targets = len(target_atoms)
+
+    print(f"Computing alchemical derivatives for {num_targets} target atoms ({xc}/{basis})...")
+    mol = build_mol(atoms, charge, basis)
+    mf = make_scf(mol, xc)
+    mf.conv_tol = conv_tol
+    mf.kernel()
+    if not mf.converged:
+        print("Warning: reference SCF not converged.")
+    dm0 = mf.make_rdm1()
+    rinv = get_rinv_integrals(mol, target_atoms)
+    gradient = get_alchemical_gradient(mol, dm0, rinv, target_atoms)
+
+    fields = [(n, s) for n in range(num_targets) for s in (step, -step)]
+    workers = workers or max(1, (os.cpu_count() or 1) // threads)
+    initargs = (atoms, charge, basis, xc, dm0, target_atoms, conv_tol, threads)
+    hessian = np.zeros((num_targets, num_targets))
+    cycles = []
+    with Pool(workers, initializer=_init_derivative_worker, initargs=initargs) as pool:
+        for n, s, grad, converged, n_cycles in tqdm(pool.imap_unordered(run_field, fields), total=len(fields), desc="Alchemical response"):
+            if not converged:
+                print(f"Warning: field {s:+} on target {n} not converged.")
+            hessian[:, n] += np.sign(s) * grad / (2 * step)
+            if n_cycles is not None:
+                cycles.append(n_cycles)
+    hessian = 0.5 * (hessian + hessian.T)
+
+    if cycles:
+        print(f"Average SCF cycles per field: {np.mean(cycles):.1f}")
+    np.savez(output_file, energy=mf.e_tot * HARTREE2EV, gradient=gradient * HARTREE2EV,
+             hessian=hessian * HARTREE2EV, xc=xc, basis=basis)
+    print(f"Saved alchemical derivatives to {output_file}")
+    return mf.e_tot * HARTREE2EV, gradient * HARTREE2EV, hessian * HARTREE2EV
@@ -4,6 +4,7 @@ import cclib
 import numpy as np
 from tqdm import tqdm
 from multiprocessing import Pool
+from pymatgen.core import Element
 
 def process_file_optimized(args):
     filename, target_indices, properties = args
@@ -47,32 +48,42 @@ def extract_all(directory, output_feather, config, properties=["Energy_DFT"]):
     
     work_items = [(f, target_indices, properties) for f in out_files]
     
-    rows = []
-    skipped = []
-    
     with Pool() as pool:
         results = list(tqdm(pool.imap(process_file_optimized, work_items), total=len(work_items), desc="Extracting results"))
-        
-        for res in results:
-            if res["status"] == "ok":
-                # Add z-scores based on atomnos and reference
-                # We need to know the mapping. 
-                # C(6) -> 0, B(5) -> -1, N(7) -> 1
-                row = res["row"]
-                atomnos = res["atomnos"]
-                for i, idx in enumerate(target_indices):
-                    z = 0
-                    if atomnos[idx] == 5: z = -1
-                    elif atomnos[idx] == 7: z = 1
-                    row[f"z{i}"] = z
-                rows.append(row)
-            else:
-                skipped.append((res["filename"], res["error"]))
+
+    return write_training_feather(results, output_feather, config)
+
+def write_training_feather(results, output_feather, config):
+    """
+    Turns per-calculation results ({"status", "filename", "row", "atomnos"} dicts)
+    into the training table: z0..zn first, then the extracted properties.
+    """
+    target_indices = config["target_indices"]
+    # Reference atomic numbers of the targets (older configs only have a single target_type)
+    target_z = config.get("target_z") or [Element(config["target_type"]).Z] * len(target_indices)
+
+    rows = []
+    skipped = []
+    for res in results:
+        if res["status"] == "ok":
+            # Add z-scores based on atomnos and reference
+            # z is the change in nuclear charge, e.g. C(6) -> 0, B(5) -> -1, N(7) -> 1, O(8) -> 2
+            row = res["row"]
+            atomnos = res["atomnos"]
+            for i, idx in enumerate(target_indices):
+                row[f"z{i}"] = int(atomnos[idx]) - target_z[i]
+            rows.append(row)
+        else:
+            skipped.append((res["filename"], res["error"]))
 
     if skipped:
         print(f"Skipped {len(skipped)} files due to errors.")
         for f, e in skipped[:5]: print(f"  {f}: {e}")
 
+    if not rows:
+        print("No results to save.")
+        return None
+
     df = pl.DataFrame(rows)
     
     # Reorder columns: z0..zn first, then others
@@ -0,0 +1,126 @@
+import os
+import json
+import hashlib
+import inspect
+
+STATE_FILE = ".pipeline_state.json"
+
+def hash_value(value):
+    """Hash of any JSON-serializable parameter."""
+    return hashlib.sha256(json.dumps(value, sort_keys=True, default=str).encode()).hexdigest()
+
+def hash_file(path, chunk_size=1 << 20):
+    """Content hash of a file (None if missing)."""
+    if not os.path.exists(path):
+        return None
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(chunk_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+def hash_directory(path, suffix):
+    """Content hash of every file with the given suffix in a directory (None if missing)."""
+    if not os.path.isdir(path):
+        return None
+    names = sorted(f for f in os.listdir(path) if f.endswith(suffix))
+    return hash_value([(name, hash_file(os.path.join(path, name))) for name in names])
+
+def hash_code(*objects):
+    """Code version of a phase: hash of the source of the functions/modules it runs."""
+    return hash_value([inspect.getsource(obj) for obj in objects])
+
+def make_phase(name, outputs, upstream=(), temporaries=(), **components):
+    """
+    Describes one pipeline phase: its output files and a hash per input component
+    (parameters, input files, code). Upstream phases enter through their keys, so a
+    phase re-runs whenever anything it depends on changes.
+    temporaries are partial results that may only be resumed with the same key.
+    """
+    hashes = {k: hash_value(v) for k, v in components.items()}
+    for phase in upstream:
+        hashes[f"upstream {phase['name']}"] = phase["key"]
+    return {"name": name, "outputs": list(outputs), "temporaries": list(temporaries),
+            "components": hashes, "key": hash_value(hashes)}
+
+def load_state(path=STATE_FILE):
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            return json.load(f)
+    return {}
+
+def save_state(state, path=STATE_FILE):
+    with open(path, "w") as f:
+        json.dump(state, f, indent=4)
+
+def get_run_reasons(state, phase, force=False):
+    """Reasons why a phase has to run (empty list if its recorded outputs are up to date)."""
+    reasons = []
+    if force:
+        reasons.append("forced (-r)")
+    recorded = state.get(phase["name"])
+    if recorded is None:
+        reasons.append("never run")
+    elif recorded["key"] != phase["key"]:
+        old = recorded.get("components", {})
+        for component, value in phase["components"].items():
+            if old.get(component) != value:
+                reasons.append(f"{component} changed")
+        for component in old:
+            if component not in phase["components"]:
+                reasons.append(f"{component} removed")
+    for output in phase["outputs"]:
+        if not os.path.exists(output):
+            reasons.append(f"{output} missing")
+    return reasons
+
+def is_stale(state, phase):
+    """True if the phase was recorded with different inputs (its outputs no longer match them)."""
+    recorded = state.get(phase["name"])
+    return recorded is not None and recorded["key"] != phase["key"]
+
+def record_phase(state, phase, path=STATE_FILE):
+    state[phase["name"]] = {"key": phase["key"], "components": phase["components"], "outputs": phase["outputs"]}
+    save_state(state, path)
+
+def run_phase(state, phase, action, force=False, trust_existing=False):
+    """
+    Runs action() if the phase is out of date and records it on success (truthy return).
+    Outputs recorded for different inputs are removed first so they are never reused;
+    directories are left to the action, which owns their contents.
+    Without a record (first run, lost state file) the phase runs again, unless trust_existing
+    is set and all its outputs exist: then they are adopted as produced from the current inputs.
+    Returns False if the action failed.
+    """
+    reasons = get_run_reasons(state, phase, force)
+    if not reasons:
+        print(f"Workflow: {phase['name']} is up to date.")
+        return True
+    if trust_existing and not force and phase["name"] not in state \
+            and all(os.path.exists(f) for f in phase["outputs"]):
+        print(f"Workflow: Adopting existing outputs of {phase['name']} (--trust-existing).")
+        record_phase(state, phase)
+        return True
+    print(f"Workflow: Running {phase['name']} ({', '.join(reasons)}).")
+    if force or phase["name"] not in state:
+        # Partial results of unknown or different inputs are never resumed
+        for f in phase["temporaries"]:
+            if os.path.exists(f):
+                os.remove(f)
+    if force or is_stale(state, phase):
+        for f in phase["outputs"] + phase["temporaries"]:
+            if os.path.isfile(f):
+                os.remove(f)
+    if not action():
+        return False
+    record_phase(state, phase)
+    return True
+
+def explain(state, phases, force=False):
+    """Prints which phases would run and why."""
+    for phase in phases:
+        reasons = get_run_reasons(state, phase, force)
+        if reasons:
+            print(f"  {phase['name']}: run ({', '.join(reasons)})")
+        else:
+            print(f"  {phase['name']}: up to date")
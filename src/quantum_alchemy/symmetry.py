@@ -147,23 +147,59 @@ def get_cycle_lengths(perm):
             lengths.append(length)
     return lengths
 
-def get_pet_counts_by_k(perms, num_targets, max_k):
+def get_stabilizer_chain(p_invs, num_targets):
+    """
+    Builds the pointwise stabilizer chain G = G_0 >= G_1 >= ... along the base 0, 1, ..., n-1.
+    Level i is the transversal of G_{i+1} in G_i: a dict mapping every point b in the orbit
+    of i under G_i to a coset representative u with u[i] = b.
+    The permutations from symmetry.py are already the full group, so the chain is obtained by
+    sifting the elements directly (no Schreier generators needed). Stops at the trivial stabilizer.
+    """
+    level_group = [list(p) for p in p_invs]
+    chain = []
+    for i in range(num_targets):
+        if len(level_group) <= 1:
+            break
+        transversal = {}
+        stabilizer = []
+        for p in level_group:
+            transversal.setdefault(p[i], p)
+            if p[i] == i:
+                stabilizer.append(p)
+        chain.append(transversal)
+        level_group = stabilizer
+    return chain
+
+def get_coset_checks(chain, num_targets):
+    """
+    For each depth pos, the chain levels i < pos whose orbit contains pos.
+    Every element u of G_i with u[i] = pos fixes 0..i-1, so once atom pos is assigned the
+    image at position i is decided for the whole coset by a single comparison.
+    """
+    checks = [[] for _ in range(num_targets)]
+    for i, transversal in enumerate(chain):
+        for b in transversal:
+            if b > i:
+                checks[b].append(i)
+    return checks
+
+def get_pet_counts_by_k(perms, num_targets, max_k, num_colors=2):
     """
     Calculates the number of unique colorings for each k substitutions (where k is the number of non-reference atoms).
-    Assumes 2 possible non-reference colors (e.g., B and N).
+    num_colors is the number of possible non-reference colors (default 2, e.g., B and N).
     """
     import numpy as np
     
-    # Polynomial for each permutation: product of (1 + 2*x^L) for each cycle of length L
+    # Polynomial for each permutation: product of (1 + m*x^L) for each cycle of length L
     total_poly = np.poly1d([0])
     
     for p in perms:
         lengths = get_cycle_lengths(p)
         poly = np.poly1d([1])
         for L in lengths:
-            # (1 + 2*x^L)
+            # (1 + m*x^L)
             term_coeffs = [0] * (L + 1)
-            term_coeffs[0] = 2 # 2*x^L
+            term_coeffs[0] = num_colors # m*x^L
             term_coeffs[L] = 1 # 1
             poly *= np.poly1d(term_coeffs)
         total_poly += poly
@@ -179,6 +215,33 @@ def get_pet_counts_by_k(perms, num_targets, max_k):
             
     return counts
 
+def get_pet_counts_by_colors(perms, max_k):
+    """
+    Two-variable version of get_pet_counts_by_k: number of unique colorings for each
+    (n_minus, n_plus) pair with n_minus + n_plus <= max_k.
+    Uses the product of (1 + x^L + y^L) over the cycles, with exact integer coefficients.
+    """
+    size = max_k + 1
+    total = np.zeros((size, size), dtype=object)
+
+    for p in perms:
+        poly = np.zeros((size, size), dtype=object)
+        poly[0, 0] = 1
+        for L in get_cycle_lengths(p):
+            if L > max_k:
+                continue # x^L and y^L terms fall outside the truncation
+            term = poly.copy()
+            term[L:, :] += poly[:size - L, :]
+            term[:, L:] += poly[:, :size - L]
+            poly = term
+        total += poly
+
+    counts = {}
+    for n_minus in range(size):
+        for n_plus in range(size - n_minus):
+            counts[(n_minus, n_plus)] = int(total[n_minus, n_plus] // len(perms))
+    return counts
+
 def get_pet_count(perms, num_colors):
     """Calculates total unique colorings using Polya Enumeration Theorem."""
     total = 0